@@ -1,31 +1,13 @@
+import atexit
+import filecmp
 import os
 import sys
+import shutil
 import subprocess
 import re
+from collections import deque
 from pathlib import Path
 
-use_offline_dependency = """
-final addDownloadedDependenciesRepository(rooted, receiver) {
-  receiver.repositories.maven {
-    url uri("${rooted.rootDir}/qct-gradle/configuration")
-    metadataSources {
-      mavenPom()
-      artifact()
-    }
-  }
-}
-
-settingsEvaluated { settings ->
-  addDownloadedDependenciesRepository settings, settings.buildscript
-  addDownloadedDependenciesRepository settings, settings.pluginManagement
-}
-
-allprojects { project ->
-  addDownloadedDependenciesRepository project, project.buildscript
-  addDownloadedDependenciesRepository project, project
-}
-"""
-
 # Define the repository URL (unchanged)
 simple_repository_url = """maven {
     url uri("${project.projectDir}/qct-gradle/configuration")
@@ -54,273 +36,108 @@ artifact()
 """
 
 
-run_build_env_copy_content = '''
-import java.nio.file.Files
-import java.nio.file.StandardCopyOption
-
-gradle.rootProject {
-    // Task to run buildEnvironment and capture its output
-    task runAndParseBuildEnvironment {
-        doLast {
-            def buildEnvironmentOutput = new ByteArrayOutputStream()
-            exec {
-                // Use the gradlew wrapper from the project's directory
-                commandLine "${project.projectDir}/gradlew", 'buildEnvironment'
-                standardOutput = buildEnvironmentOutput
-            }
-
-            def outputString = buildEnvironmentOutput.toString('UTF-8')
-            def localM2Dir = new File(System.getProperty("user.home"), ".m2/repository")
-            def gradleCacheDir = new File("${project.projectDir}/qct-gradle/START/caches/modules-2/files-2.1")
-            def destinationDir = new File("${project.projectDir}/qct-gradle/configuration")
-
-            // Helper method to copy files to m2 format
-            def copyToM2 = { File file, String group, String name, String version ->
-                def m2Path = "${group.replace('.', '/')}/${name}/${version}"
-                def m2Dir = new File(destinationDir, m2Path)
-                m2Dir.mkdirs()
-                def m2File = new File(m2Dir, file.name)
-                println "this is the m2 path ${m2Path}"
-                Files.copy(file.toPath(), m2File.toPath(), StandardCopyOption.REPLACE_EXISTING)
-            }
-
-            // Helper method to search and copy artifact in m2 directory
-            def searchAndCopyArtifactInM2 = { String group, String name, String version ->
-                def m2Path = "${group.replace('.', '/')}/${name}/${version}"
-                def artifactDir = new File(localM2Dir, m2Path)
-                if (artifactDir.exists() && artifactDir.isDirectory()) {
-                    println "Found artifact in local m2: ${artifactDir.path}"
-                    artifactDir.listFiles().each { file ->
-                        println "  Copying File: ${file.name}"
-                        copyToM2(file, group, name, version)
-                    }
-                    return true
-                }
-                return false
-            }
-
-            // Helper method to search and copy artifact in Gradle cache directory
-            def searchAndCopyArtifactInGradleCache = { String group, String name, String version ->
-                def cachePath = "${group}/${name}/${version}"  // Path as is for Gradle cache
-                def artifactDir = new File(gradleCacheDir, cachePath)
-                if (artifactDir.exists() && artifactDir.isDirectory()) {
-                    println "Found artifact in Gradle cache: ${artifactDir.path}"
-                    artifactDir.listFiles().each { file ->
-                        println "  Copying File: ${file.name}"
-                        // Change path to m2 structure
-                        copyToM2(file, group, name, version)
-                    }
-                    return true
-                }
-                return false
-            }
-
-            // Helper method to search and copy artifact in local m2 or Gradle cache
-            def searchAndCopyArtifact = { String group, String name, String version ->
-                if (!searchAndCopyArtifactInM2(group, name, version)) {
-                    if (!searchAndCopyArtifactInGradleCache(group, name, version)) {
-                        println "Artifact not found: ${group}:${name}:${version}"
-                    }
-                }
-            }
-
-            // Parse the buildEnvironment output
-            println "=== Parsing buildEnvironment Output ==="
-            def pattern = ~/(\S+:\S+:\S+)/
-            outputString.eachLine { line ->
-                def matcher = pattern.matcher(line)
-                if (matcher.find()) {
-                    def artifact = matcher.group(1)
-                    def (group, name, version) = artifact.split(':')
-                    searchAndCopyArtifact(group, name, version)
-                }
-            }
-        }
-    }
-}
-'''
-
-print_contents = '''
-
-    import java.nio.file.Files
-    import java.nio.file.Path
-    import java.nio.file.StandardCopyOption
-
-    gradle.rootProject {
-        task printResolvedDependenciesAndTransformToM2 {
-            doLast {
-                def destinationDir = new File("${project.projectDir}/qct-gradle/configuration")
-
-                // Helper method to copy files to m2 format
-                def copyToM2 = { File file, String group, String name, String version ->
-                    def m2Path = "${group.replace('.', '/')}/${name}"
-                    def m2Dir = new File(destinationDir, m2Path)
-                    m2Dir.mkdirs()
-                    def m2File = new File(m2Dir, file.name)
-                    Files.copy(file.toPath(), m2File.toPath(), StandardCopyOption.REPLACE_EXISTING)
-                }
+# the Gradle init scripts ship in gradle_init/ next to this file and are shared with the other platform's copy-deps script
+gradle_init_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gradle_init')
 
-                // Print buildscript configurations (plugins)
-                println "=== Plugins ==="
-                buildscript.configurations.each { config ->
-                    if (config.canBeResolved) {
-                        println "Configuration: ${config.name}"
-                        config.incoming.artifactView { viewConfig ->
-                            viewConfig.lenient(true)
-                        }.artifacts.each { artifact ->
-                            def artifactPath = artifact.file.path
-                            if (!artifactPath.startsWith(destinationDir.path)) {
-                                println "  Transforming Dependency: ${artifact.id.componentIdentifier.displayName}, File: ${artifact.file}"
-                                def parts = artifact.id.componentIdentifier.displayName.split(':')
-                                if (parts.length == 3) {
-                                    def (group, name, version) = parts
-                                    copyToM2(artifact.file, group, name, version)
-                                } else {
-                                    println "Unexpected format: ${artifact.id.componentIdentifier.displayName}"
-                                }
-                            }
-                        }
-                        println ""
-                    } else {
-                        println "Configuration: ${config.name} cannot be resolved."
-                        println ""
-                    }
-                }
+def get_init_script(init_name):
+    return os.path.join(gradle_init_dir, init_name)
 
-                // Print regular project dependencies
-                println "=== Dependencies ==="
-                configurations.each { config ->
-                    if (config.canBeResolved) {
-                        println "Configuration: ${config.name}"
-                        config.incoming.artifactView { viewConfig ->
-                            viewConfig.lenient(true)
-                        }.artifacts.each { artifact ->
-                            def artifactPath = artifact.file.path
-                            if (!artifactPath.startsWith(destinationDir.path)) {
-                                println "  Transforming Dependency: ${artifact.id.componentIdentifier.displayName}, File: ${artifact.file}"
-                                def (group, name, version) = artifact.id.componentIdentifier.displayName.split(':')
-                                copyToM2(artifact.file, group, name, version)
-                            }
-                        }
-                        println ""
-                    } else {
-                        println "Configuration: ${config.name} cannot be resolved."
-                        println ""
-                    }
-                }
-
-                // Resolve and print plugin marker artifacts
-                println "=== Plugin Marker Artifacts ==="
-                def pluginMarkerConfiguration = configurations.detachedConfiguration()
-
-                // Access plugin dependencies from the buildscript block
-                buildscript.configurations.classpath.resolvedConfiguration.firstLevelModuleDependencies.each { dependency ->
-                    dependency.children.each { transitiveDependency ->
-                        def pluginArtifact = "${transitiveDependency.moduleGroup}:${transitiveDependency.moduleName}:${transitiveDependency.moduleVersion}"
-                        pluginMarkerConfiguration.dependencies.add(dependencies.create(pluginArtifact))
-                    }
-                }
-
-                pluginMarkerConfiguration.incoming.artifactView { viewConfig ->
-                    viewConfig.lenient(true)
-                }.artifacts.each { artifact ->
-                    def artifactPath = artifact.file.path
-                    if (!artifactPath.startsWith(destinationDir.path)) {
-                        println "  Transforming Plugin Marker: ${artifact.id.componentIdentifier.displayName}, File: ${artifact.file}"
-                        def (group, name, version) = artifact.id.componentIdentifier.displayName.split(':')
-                        copyToM2(artifact.file, group, name, version)
-                    }
-                }
-            }
-        }
-    }
-'''
-
-copy_modules_script_content = '''
-gradle.rootProject {
-    ext.destDir = "$projectDir"
-    ext.startDir = "$destDir/qct-gradle/START"
-    ext.finalDir = "$destDir/qct-gradle/FINAL"
-
-    task buildProject(type: Exec) {
-        commandLine "$destDir/gradlew", "build", "-p", destDir, "-g", startDir
-    }
-
-    task copyModules2 {
-        dependsOn buildProject
-        doLast {
-            def srcDir = file("$startDir/caches/")
-            def destDir = file("$finalDir/caches/")
-            
-            if (srcDir.exists()) {
-                copy {
-                    from srcDir
-                    into destDir
-                    exclude '**/*.lock'
-                }
-                println "modules2 folder copied successfully."
-            } else {
-                throw new GradleException("Failed to copy the modules2 folder: source directory does not exist.")
-            }
-        }
-    }
-}
-
-'''
-
-custom_init_script_content = '''
-gradle.rootProject {
-    task cacheToMavenLocal(type: Copy) {
-        def destinationDirectory = "${project.projectDir}/qct-gradle/configuration"
-        println(destinationDirectory)
-        from new File("${project.projectDir}/qct-gradle/START", "caches/modules-2/files-2.1")
-        into destinationDirectory
-        eachFile {
-            List<String> parts = it.path.split('/')
-            println(parts)
-            it.path = [parts[0].replace('.','/'), parts[1], parts[2], parts[4]].join('/')
-        }
-        includeEmptyDirs false
-    }
-}
-'''
-
-def create_init_script(directory, init_name, content):
-    qct_gradle_dir = os.path.join(directory, 'qct-gradle')
-    os.makedirs(qct_gradle_dir, exist_ok=True)
-    file_path = os.path.join(qct_gradle_dir, init_name)
-    with open(file_path, 'w') as file:
-        file.write(content)
-    print(f'init.gradle file created successfully at {file_path}')
+def copy_init_script(directory, init_name):
+    # qct-gradle is uploaded with the project, so the init script for its offline build is placed there too;
+    # an unchanged copy is left alone instead of being rewritten on every run
+    source_path = get_init_script(init_name)
+    file_path = os.path.join(directory, 'qct-gradle', init_name)
+    if not os.path.exists(file_path) or not filecmp.cmp(source_path, file_path, shallow=False):
+        shutil.copyfile(source_path, file_path)
+        print(f'init.gradle file created successfully at {file_path}')
     return file_path
 
 def make_gradlew_executable(gradlew_path):
-    # check=True causes an Exception to be thrown on non-zero status code
+    if os.access(gradlew_path, os.X_OK):
+        print(f'gradlew is already executable at {gradlew_path}')
+        return
     try:
-        subprocess.run(['chmod', '+x', gradlew_path], check=True, text=True, capture_output=True)
+        # same effect as `chmod +x` without spawning a process
+        os.chmod(gradlew_path, os.stat(gradlew_path).st_mode | 0o111)
         print(f'made gradlew executable at {gradlew_path}')
-    except Exception as e:
-        print(f'e.stdout = {e.stdout}')
-        print(f'e.stderr = {e.stderr}')
-        print(f'e.returncode = {e.returncode}')
-        print(f'e.args = {e.args}')
+    except OSError as e:
+        print(f'e.errno = {e.errno}')
+        print(f'e.strerror = {e.strerror}')
         raise # re-throw exception to be caught below
 
-def run_gradle_task(init_script_path, directory_path, task):
+# the dependency tasks run in a single Gradle invocation; a daemon lets the --info re-run after a failure reuse the
+# already-warm JVM, and stop_gradle_daemons shuts it down when this script exits
+gradle_daemon_args = ['--daemon']
+# number of trailing output lines kept from a Gradle task to report when it fails
+gradle_output_tail_lines = 500
+# names the task whose failure stopped the build, e.g. the nested project build run by buildProject
+failed_task_pattern = re.compile(r"Execution failed for task ':([^']+)'")
+# daemon JVM args used unless the project configures org.gradle.jvmargs itself
+default_gradle_jvm_args = '-Xmx2g -XX:MaxMetaspaceSize=512m'
+
+def sets_gradle_jvm_args(gradle_properties_path):
+    # read as a .properties file, so commented-out and continuation lines do not count as the key
+    continued = False
+    with open(gradle_properties_path, encoding='utf-8', errors='replace') as gradle_properties:
+        for line in gradle_properties:
+            line = line.strip()
+            is_continuation = continued
+            is_comment = not is_continuation and line[:1] in ('#', '!')
+            # an odd number of trailing backslashes joins the next line onto this one; comments never continue
+            continued = not is_comment and (len(line) - len(line.rstrip('\\'))) % 2 == 1
+            if is_continuation or is_comment:
+                continue
+            if re.split(r'[=:\s]', line, maxsplit=1)[0] == 'org.gradle.jvmargs':
+                return True
+    return False
+
+def get_gradle_jvm_args(directory_path):
+    gradle_properties_path = os.path.join(directory_path, 'gradle.properties')
+    if os.path.exists(gradle_properties_path) and sets_gradle_jvm_args(gradle_properties_path):
+        return []
+    return [f'-Dorg.gradle.jvmargs={default_gradle_jvm_args}']
+
+def run_gradle_task(init_script_path, directory_path, tasks, verbose=False, excluded_tasks=()):
+    args = [f"{directory_path}/gradlew", *tasks, *(arg for task in excluded_tasks for arg in ('-x', task)), '--init-script', init_script_path, '-g', f"{directory_path}/qct-gradle/START", '-p', f"{directory_path}", '--warning-mode=summary', *gradle_daemon_args, *get_gradle_jvm_args(directory_path)]
+    # a generic DEBUG variable is often already set by other tooling in the environment, so use a dedicated one
+    info_logging = verbose or bool(os.environ.get('QCT_GRADLE_DEBUG'))
+    if info_logging:
+        args.append('--info')
     try:
-        result = subprocess.run([f"{directory_path}/gradlew", task, '--init-script', init_script_path, '-g', f"{directory_path}/qct-gradle/START", '-p', f"{directory_path}", '--info'], check=True, text=True, capture_output=True)
+        # stream the output and keep only its tail instead of buffering the whole Gradle log in memory
+        # close_fds=False lets subprocess use posix_spawn instead of fork+exec; our own fds are non-inheritable (PEP 446)
+        with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace', close_fds=False) as process:
+            output_tail = deque(process.stdout, maxlen=gradle_output_tail_lines)
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args, output=''.join(output_tail))
     except Exception as e:
+        # printed before any re-run so the first failure's output is never lost
         print(f'e.stdout = {e.stdout}')
         print(f'e.stderr = {e.stderr}')
         print(f'e.returncode = {e.returncode}')
         print(f'e.args = {e.args}')
+        failed_task_match = failed_task_pattern.search(e.stdout or '') if isinstance(e, subprocess.CalledProcessError) else None
+        failed_task = failed_task_match.group(1) if failed_task_match else None
+        # a failing project build would only fail the same way again, after repeating the whole build
+        if isinstance(e, subprocess.CalledProcessError) and not info_logging and failed_task != 'buildProject':
+            retry_tasks, retry_excluded_tasks = tasks, excluded_tasks
+            if failed_task in tasks:
+                # every requested task runs after buildProject, so it already succeeded; resume from the failed task
+                # instead of repeating the project build and the tasks that completed, which add no diagnostics
+                retry_tasks = tasks[tasks.index(failed_task):]
+                retry_excluded_tasks = (*excluded_tasks, 'buildProject')
+            # nothing reads Gradle's output on success, so --info is only paid for when diagnosing a failure
+            print(f"Gradle tasks {' '.join(tasks)} failed with return code {e.returncode}, re-running {' '.join(retry_tasks)} with --info")
+            run_gradle_task(init_script_path, directory_path, retry_tasks, verbose=True, excluded_tasks=retry_excluded_tasks)
+            print(f"WARNING: Gradle tasks {' '.join(retry_tasks)} succeeded on the --info re-run after failing with return code {e.returncode}; the first failure may be intermittent")
+            return
         raise # re-throw exception to be caught below
 
 def run_offline_build(init_script_path, directory_path):
     try:
         result = subprocess.run(
             [f"{directory_path}/gradlew", 'build', '--init-script', init_script_path, '-g', f"{directory_path}/qct-gradle/FINAL", '-p', f"{directory_path}", '--offline'],
-            check=True, text=True, capture_output=True
+            check=True, text=True, capture_output=True, close_fds=False
         )
         print("run_offline_build() succeeded:")
         print(result.stdout)
@@ -330,15 +147,24 @@ def run_offline_build(init_script_path, directory_path):
         print(f'e.returncode = {e.returncode}')
         print(f'e.args = {e.args}')
         raise
- 
-def create_run_task(path, init_file_name, content, task_name):
-    init_script_path = create_init_script(path, init_file_name, content)
-    run_gradle_task(init_script_path, path, task_name)
+
+def stop_gradle_daemons(directory_path):
+    # the daemons started for the qct-gradle user homes are never reused after this script exits
+    for user_home in ('START', 'FINAL'):
+        gradle_user_home = f"{directory_path}/qct-gradle/{user_home}"
+        # a user home without a daemon directory never had a daemon; skip it rather than launching the wrapper for nothing
+        if not os.path.isdir(os.path.join(gradle_user_home, 'daemon')):
+            continue
+        try:
+            subprocess.run([f"{directory_path}/gradlew", '--stop', '-g', gradle_user_home], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, close_fds=False)
+        except OSError as e:
+            print(f'Failed to stop the Gradle daemons for {gradle_user_home}: {e}')
 
 def run(directory_path):
     gradlew_path = os.path.join(directory_path, 'gradlew')
     if os.path.exists(gradlew_path):
         print("gradlew executable found")
+        atexit.register(stop_gradle_daemons, directory_path)
         try:
             make_gradlew_executable(gradlew_path)
         except Exception as e:
@@ -348,11 +174,12 @@ def run(directory_path):
         print("gradlew executable not found. Please ensure you have a Gradle wrapper at the root of your project. Run 'gradle wrapper' to generate one.")
         sys.exit(1)
     try:
-        create_run_task(directory_path, 'copyModules-init.gradle', copy_modules_script_content, 'copyModules2')
-        create_run_task(directory_path, 'custom-init.gradle', custom_init_script_content, 'cacheToMavenLocal')
-        create_run_task(directory_path, 'resolved-paths-init.gradle', print_contents, 'printResolvedDependenciesAndTransformToM2')
-        create_run_task(directory_path,'buildEnv-copy-init.gradle', run_build_env_copy_content, 'runAndParseBuildEnvironment')
-        build_offline_dependencies = create_init_script(directory_path, 'use-downloaded-dependencies.gradle', use_offline_dependency)
+        os.makedirs(os.path.join(directory_path, 'qct-gradle'), exist_ok=True)
+        # only this script's own Gradle run reads the copy-dependencies init script, so it is used in place
+        copy_dependencies_init = get_init_script('copyDependencies-init.gradle')
+        # copyModules2 builds the project into qct-gradle/START, which the remaining tasks read from
+        run_gradle_task(copy_dependencies_init, directory_path, ['copyModules2', 'cacheToMavenLocal', 'printResolvedDependenciesAndTransformToM2', 'runAndParseBuildEnvironment'])
+        build_offline_dependencies = copy_init_script(directory_path, 'use-downloaded-dependencies.gradle')
         run_offline_build(build_offline_dependencies, directory_path)
     except Exception as e:
         print(f"An error occurred: {e}")